@@ -1,12 +1,18 @@
 from flask import Flask
 from dotenv import load_dotenv
+from concurrent.futures import ThreadPoolExecutor
+import logging
 import os
+import threading
 
 def create_app():
     app = Flask(__name__)
     
     # Load environment variables from .env file
     load_dotenv()  # Ensure python-dotenv is installed
+
+    # Debug output from the request path is only formatted when LOG_LEVEL allows it
+    logging.basicConfig(level=os.getenv('LOG_LEVEL', 'WARNING'))
     
     # Configure your app with environment variables
     app.config['UPSTAGE_API_KEY'] = os.getenv('UPSTAGE_API_KEY')
@@ -16,8 +22,14 @@ def create_app():
     app.config['UPLOAD_FOLDER'] = './uploads'
     
     # Make sure the upload folder exists
-    if not os.path.exists(app.config['UPLOAD_FOLDER']):
-        os.makedirs(app.config['UPLOAD_FOLDER'])
+    os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+
+    # Background workers for PDF processing, with (future, start time) keyed by PDF hash
+    app.extensions['pdf_pool'] = ThreadPoolExecutor(max_workers=4)
+    app.extensions['pdf_tasks'] = {}
+    app.extensions['pdf_tasks_lock'] = threading.Lock()
+    # Long-lived workers for /upload-batch, so their SQLite connections are reused
+    app.extensions['pdf_batch_pool'] = ThreadPoolExecutor(max_workers=8)
     
     # Register blueprints
     from .routes import main  # Import blueprint from routes
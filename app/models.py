@@ -1,13 +1,27 @@
 import sqlite3
 import os
+import logging
+import threading
+import hashlib
+import json
+import time
+import orjson
 from dotenv import load_dotenv
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from requests_toolbelt import MultipartEncoder
 from together import Together  # Ensure this is the correct library
 import re
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from html.parser import HTMLParser
 from openai import OpenAI
 
 load_dotenv()
 
+log = logging.getLogger(__name__)
+
 # API keys from .env
 UPSTAGE_API_KEY = os.getenv('UPSTAGE_API_KEY')
 TOGETHER_API_KEY = os.getenv('TOGETHER_API_KEY')
@@ -17,34 +31,155 @@ TOGETHER_API_KEY = os.getenv('TOGETHER_API_KEY')
 upstage_client = requests.Session()
 upstage_client.headers.update({'Authorization': f'Bearer {UPSTAGE_API_KEY}'})
 
+# Initialize Solar client (OpenAI-compatible), shared across threads
+solar_client = OpenAI(
+    api_key=UPSTAGE_API_KEY,
+    base_url="https://api.upstage.ai/v1/solar"
+)
+
 # Initialize TogetherAI client
 together_client = Together(api_key=TOGETHER_API_KEY)
 
-def parse_pdf(pdf_path):
-    """
-    Parse PDF using UpStage Document-Parse API.
-    Extract expenses with 'from', 'to', and 'amount' fields.
-    """
-    url = "https://api.upstage.ai/v1/document-ai/document-parse"
-    files = {"document": open(pdf_path, "rb")}
+# Pooled keep-alive session for the Together REST API, retrying transient errors.
+# POST must be allowed explicitly; the chat completion calls are safe to repeat.
+together_session = requests.Session()
+together_session.mount('https://', HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    max_retries=Retry(
+        total=3,
+        backoff_factor=0.3,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=frozenset(['POST'])
+    )
+))
+together_session.headers.update({
+    'authorization': f'Bearer {TOGETHER_API_KEY}',
+    'accept': 'application/json',
+    'content-type': 'application/json'
+})
 
-    response = upstage_client.post(url, files=files)
-    response.raise_for_status()
+DB_PATH = 'expenses.db'
 
-    parsed_data = response.json()
-    print(f"Raw Parsed Data: {parsed_data}")
+# First SELECT statement in an LLM reply, treating string literals as a unit so
+# a ';' inside quotes doesn't end it. A literal can't be followed directly by
+# another quote, which keeps '' escapes unambiguous and the match linear.
+_SQL_RE = re.compile(r"SELECT\s(?:[^;']|'(?:[^']|'')*'(?!'))*;")
 
-    html_content = parsed_data['content']['html']
-    expenses = extract_expenses_from_html(html_content)
-    # print(f"Parsed Expenses: {expenses}")
-    return expenses
+# SQL string literal, with '' as an escaped quote, and any AS before it
+_SQL_STRING_RE = re.compile(r"(\bAS\s+)?'(?:[^']|'')*'", re.I)
 
-def extract_expenses_from_html(html_content):
+# Models tried in order by generate_query, with their max_tokens
+QUERY_MODELS = [
+    ("meta-llama/Meta-Llama-3.1-8B-Instruct-Turbo", 80),
+    ("meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo", 150),
+]
+
+# Categories assigned by extract_expenses_from_html
+_CATEGORIES = {
+    'transfers', 'utilities', 'education', 'entertainment', 'food',
+    'accommodation', 'onetime', 'subscriptions'
+}
+
+# Whole-question templates answered directly, without asking the LLM for SQL.
+# Each is anchored at both ends, so any extra qualifier ("in March", "excluding
+# rent", another date) means no match and the question goes to the LLM.
+_DATE = r'(\d{4}-\d{2}-\d{2})'
+_LIST = r"(?:list|show)(?: me)?(?: all)?(?: of)?(?: my)?"
+_INTENTS = [
+    (re.compile(r"^\s*(?:what(?: is|'s) )?(?:the )?total (?:amount )?(?:i )?(?:spent|spend|spending) on (?P<category>[a-z]+)\W*$", re.I),
+     'SELECT SUM(amount) FROM expenses WHERE category = ? COLLATE NOCASE;'),
+    (re.compile(r"^\s*how much (?:did|have) i (?:spend|spent) on (?P<category>[a-z]+)\W*$", re.I),
+     'SELECT SUM(amount) FROM expenses WHERE category = ? COLLATE NOCASE;'),
+    (re.compile(rf"^\s*{_LIST} (?P<category>[a-z]+) (?:expenses|transactions)\W*$", re.I),
+     'SELECT date, account, amount, category FROM expenses WHERE category = ? COLLATE NOCASE ORDER BY date;'),
+    (re.compile(rf"^\s*{_LIST} (?:expenses|transactions) between {_DATE} and {_DATE}\W*$", re.I),
+     'SELECT date, account, amount, category FROM expenses WHERE date BETWEEN ? AND ? ORDER BY date;'),
+]
+
+# Statement table layout handled without the LLM, and how its cells are read
+_TABLE_HEADERS = {'date', 'description', 'amount'}
+# Only formats that can't confuse day and month (no 03/04/2024)
+_TABLE_DATE_FORMATS = ['%Y-%m-%d', '%d %b %Y', '%d %B %Y']
+_TABLE_AMOUNT_RE = re.compile(r'^([+-]?)\s*\$?([\d,]+(?:\.\d+)?)\s*([+-]?)$')
+# Name after the last "/", e.g. "RAJ" in "FUND TRANSFER TO A/ RAJ"
+_TABLE_ACCOUNT_RE = re.compile(r"^\s*([A-Z][A-Z0-9&.'-]*(?:\s+[A-Z][A-Z0-9&.'-]*)*)\s*$")
+_TABLE_TRANSFER_TO_RE = re.compile(r'\bTRANSFER TO\b')
+# A single plain word, like the personal names the prompt treats as transfers
+_TABLE_PERSON_RE = re.compile(r"^[A-Z][A-Z'-]*$")
+
+# Known merchant names and their categories; anything else goes to the LLM
+_ACCOUNT_CATEGORIES = {
+    'NETFLIX': 'subscriptions', 'SPOTIFY': 'subscriptions', 'DISNEY': 'subscriptions',
+    'YOUTUBE': 'subscriptions', 'STARBUCKS': 'food', 'MCDONALD': 'food',
+    'KFC': 'food', 'GRABFOOD': 'food', 'FOODPANDA': 'food', 'SP GROUP': 'utilities',
+    'SINGTEL': 'utilities', 'STARHUB': 'utilities', 'AIRBNB': 'accommodation',
+    'UDEMY': 'education', 'COURSERA': 'education', 'STEAM': 'entertainment',
+}
+_ACCOUNT_KEYWORD_RES = {
+    keyword: re.compile(rf'(?<![A-Z0-9]){re.escape(keyword)}(?![A-Z0-9])')
+    for keyword in _ACCOUNT_CATEGORIES
+}
+
+# One SQLite connection per thread, reused across requests
+_tls = threading.local()
+
+# Statements allowed on the read-only connection used for generated queries
+_READ_ONLY_ACTIONS = {
+    sqlite3.SQLITE_SELECT, sqlite3.SQLITE_READ,
+    sqlite3.SQLITE_FUNCTION, sqlite3.SQLITE_RECURSIVE
+}
+
+def _read_only_authorizer(action, *args):
+    return sqlite3.SQLITE_OK if action in _READ_ONLY_ACTIONS else sqlite3.SQLITE_DENY
+
+def _conn(db_path=DB_PATH, read_only=False):
     """
-    Extract expenses from HTML content using UpStage Solar LLM.
+    Return this thread's cached connection to db_path, opening it on first use.
+    A read_only connection denies everything but SELECT statements.
     """
-    # Construct the prompt
-    prompt = (
+    conns = getattr(_tls, 'conns', None)
+    if conns is None:
+        conns = _tls.conns = {}
+    conn = conns.get((db_path, read_only))
+    if conn is None:
+        # Autocommit mode; transactions are opened explicitly with BEGIN
+        conn = sqlite3.connect(db_path, isolation_level=None)
+        # WAL persists in the database file; the rest are per-connection
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA mmap_size=268435456')  # 256 MiB
+        conn.execute('PRAGMA cache_size=-65536')  # 64 MiB
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS llm_cache (
+                input_hash TEXT PRIMARY KEY,
+                prompt_version TEXT,
+                response TEXT,
+                created_at INTEGER,
+                expires_at INTEGER
+            )
+        ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS pdf_cache (
+                sha TEXT PRIMARY KEY,
+                expenses_json TEXT,
+                created_at INTEGER
+            )
+        ''')
+        if read_only:
+            conn.set_authorizer(_read_only_authorizer)
+        conns[(db_path, read_only)] = conn
+    return conn
+
+# Bump a version when its prompt changes so stale responses are not reused
+EXTRACT_PROMPT_VERSION = 'extract-v2'
+QUERY_PROMPT_VERSION = 'query-v1'
+ANSWER_PROMPT_VERSION = 'answer-v1'
+LLM_CACHE_TTL = 7 * 86400
+
+# Solar prompt for turning statement HTML into expense rows
+_EXTRACT_PROMPT = (
     """\
     Given an HTML file containing data of a bank statement, extract the expenses and structure them for SQL insertion. 
     The data should be formatted with the following attributes: 'date', 'account', 'amount', 'category'. 
@@ -60,53 +195,285 @@ def extract_expenses_from_html(html_content):
 
     HTML: {html_content}
     """
+)
+
+# HTML above this size is split per table and extracted concurrently
+EXTRACT_CHUNK_CHARS = 30_000
+EXTRACT_WORKERS = 4
+
+# Rows per multi-row INSERT; 4 parameters each stays under SQLite's 999 limit
+INSERT_CHUNK_ROWS = 249
+
+# Keys every extracted expense must have
+EXPENSE_FIELDS = {'date', 'account', 'amount', 'category'}
+
+# Rows of query results passed to the answer prompt
+MAX_ANSWER_ROWS = 100
+
+def _loads(data):
+    """
+    Parse JSON with orjson, falling back to the stdlib for input it rejects (e.g. NaN).
+    """
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        return json.loads(data)
+
+def _cache_key(prompt_version, *parts):
+    """
+    Hash the prompt version and whitespace-normalized inputs into a cache key.
+    """
+    normalized = '\x1f'.join(' '.join(str(part).split()) for part in parts)
+    return hashlib.sha256(f"{prompt_version}\x1f{normalized}".encode()).hexdigest()
+
+def _cache_get(key):
+    """
+    Return the cached LLM response for key, or None if missing or expired.
+    """
+    row = _conn().execute(
+        'SELECT response FROM llm_cache WHERE input_hash = ? AND expires_at > ?',
+        (key, int(time.time()))
+    ).fetchone()
+    return _loads(row[0]) if row else None
+
+def _cache_put(key, prompt_version, response):
+    """
+    Store an LLM response under key for LLM_CACHE_TTL seconds.
+    """
+    now = int(time.time())
+    conn = _conn()
+    conn.execute(
+        'INSERT OR REPLACE INTO llm_cache VALUES (?, ?, ?, ?, ?)',
+        (key, prompt_version, orjson.dumps(response).decode(), now, now + LLM_CACHE_TTL)
     )
+    # Drop expired entries so answer keys (which include query results) don't pile up
+    conn.execute('DELETE FROM llm_cache WHERE expires_at <= ?', (now,))
 
-    client = OpenAI(
-        api_key=UPSTAGE_API_KEY,
-        base_url="https://api.upstage.ai/v1/solar"
+def parse_pdf(fileobj, filename):
+    """
+    Parse PDF using UpStage Document-Parse API.
+    Extract expenses with 'from', 'to', and 'amount' fields.
+    The PDF is read from the file-like fileobj and streamed in chunks.
+    """
+    url = "https://api.upstage.ai/v1/document-ai/document-parse"
+
+    encoder = MultipartEncoder(
+        fields={"document": (filename, fileobj, "application/pdf")}
     )
+    response = upstage_client.post(url, data=encoder, headers={"Content-Type": encoder.content_type})
+    response.raise_for_status()
+
+    parsed_data = _loads(response.content)
+    log.debug("Raw Parsed Data: %r", parsed_data)
+
+    html_content = parsed_data['content']['html']
+    expenses = extract_expenses_from_html(html_content)
+    # log.debug("Parsed Expenses: %r", expenses)
+    return expenses
+
+class _TableParser(HTMLParser):
+    """
+    Collect the text of every cell, row by row, from the tables in an HTML document.
+    """
+    def __init__(self):
+        super().__init__()
+        self.rows = []
+        self._cell = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'tr':
+            self.rows.append([])
+        elif tag in ('td', 'th') and self.rows:
+            self._cell = []
+
+    def handle_endtag(self, tag):
+        if tag in ('td', 'th') and self._cell is not None:
+            self.rows[-1].append(' '.join(''.join(self._cell).split()))
+            self._cell = None
+
+    def handle_data(self, data):
+        if self._cell is not None:
+            self._cell.append(data)
+
+def _parse_table_date(value):
+    for fmt in _TABLE_DATE_FORMATS:
+        try:
+            return datetime.strptime(value, fmt).strftime('%Y-%m-%d')
+        except ValueError:
+            continue
+    raise ValueError(f"Unrecognized date: {value}")
+
+def _parse_table_amount(value):
+    match = _TABLE_AMOUNT_RE.match(value)
+    if not match:
+        raise ValueError(f"Unrecognized amount: {value}")
+    leading, number, trailing = match.groups()
+    # Without exactly one explicit sign the direction of the money is unknown
+    if bool(leading) == bool(trailing):
+        raise ValueError(f"Amount without a single sign: {value}")
+    amount = float(number.replace(',', ''))
+    return -amount if '-' in (leading, trailing) else amount
+
+def _account_and_category(description):
+    """
+    Read the account and category from a description, but only when they are
+    unambiguous: the name after a "/" when it is a known merchant or a
+    one-word name in an outgoing transfer, or a single known merchant name
+    as a whole word.
+    Raises ValueError otherwise.
+    """
+    description = description.upper()
+    if '/' in description:
+        match = _TABLE_ACCOUNT_RE.match(description.rsplit('/', 1)[-1])
+        if not match:
+            raise ValueError(f"No account in description: {description}")
+        account = match.group(1)
+        if account in _ACCOUNT_CATEGORIES:
+            return account, _ACCOUNT_CATEGORIES[account]
+        # Companies get a sector category, which only the LLM can infer
+        if _TABLE_TRANSFER_TO_RE.search(description) and _TABLE_PERSON_RE.match(account):
+            return account, 'transfers'
+        raise ValueError(f"Unknown account: {account}")
+
+    keywords = [k for k, pattern in _ACCOUNT_KEYWORD_RES.items() if pattern.search(description)]
+    if len(keywords) != 1:
+        raise ValueError(f"No single known account in description: {description}")
+    return keywords[0], _ACCOUNT_CATEGORIES[keywords[0]]
+
+def _extract_expenses_from_table(html_content):
+    """
+    Extract expenses directly from a well-formed statement table with
+    date, description and amount columns.
+    Raises ValueError when the HTML does not fit that shape.
+    """
+    parser = _TableParser()
+    parser.feed(html_content)
+    rows = [row for row in parser.rows if row]
+    if len(rows) < 2:
+        raise ValueError("No statement table found")
 
+    header = [cell.lower() for cell in rows[0]]
+    if not _TABLE_HEADERS.issubset(header):
+        raise ValueError(f"Unexpected table header: {rows[0]}")
+    columns = {name: header.index(name) for name in _TABLE_HEADERS}
+
+    expenses = []
+    for row in rows[1:]:
+        cells = {name: row[index] for name, index in columns.items()}
+        if cells['description'].lower() == 'total' or cells['date'].lower() == 'total':
+            continue
+        account, category = _account_and_category(cells['description'])
+        expenses.append({
+            'date': _parse_table_date(cells['date']),
+            'account': account,
+            'amount': _parse_table_amount(cells['amount']),
+            'category': category
+        })
+    return expenses
+
+def _is_expense_list(value):
+    """
+    Check that an LLM reply has the shape insert_expenses_into_db expects.
+    """
+    return isinstance(value, list) and all(
+        isinstance(row, dict) and EXPENSE_FIELDS.issubset(row) for row in value
+    )
+
+def _solar_extract(html_content):
+    """
+    Ask the Solar LLM for the expenses in one piece of HTML.
+    Returns the parsed list, or None if the reply is not valid JSON.
+    """
     try:
         # Request a completion from the model
-        response = client.chat.completions.create(
+        response = solar_client.chat.completions.create(
             model="solar-pro",
             messages=[{
                 "role": "user",
-                "content": prompt.format(html_content=html_content)
+                "content": _EXTRACT_PROMPT.format(html_content=html_content)
             }],
         )
 
         # Log the entire response for debugging
-        print("API Response:", response)
+        log.debug("API Response: %r", response)
 
         if hasattr(response, 'choices') and len(response.choices) > 0:
             content = response.choices[0].message.content  # Access message content with dot notation
-            print("Response Content:", content)
+            log.debug("Response Content: %s", content)
     
             # Convert string to list of dictionaries
             try:
-                import json
-                expenses = json.loads(content)  # Use json.loads to parse JSON string
-                print("Parsed Expenses:", expenses)
+                expenses = _loads(content)  # Parse JSON string into a list of dictionaries
+                log.debug("Parsed Expenses: %r", expenses)
             except (ValueError, SyntaxError) as e:
-                print(f"Error parsing content: {e}")
+                log.error("Error parsing content: %s", e)
+                expenses = None
+
+            if expenses is not None and not _is_expense_list(expenses):
+                log.error("Response is not a list of expenses: %r", expenses)
                 expenses = None
 
             return expenses
         else:
-            print("Error: Response does not contain choices.")
+            log.error("Response does not contain choices.")
             return None
 
     except Exception as err:
-        print(f"Error in extract_expenses_from_html: {err}")  # Log the error
+        log.error("Error in extract_expenses_from_html: %s", err)
         raise
 
-def insert_expenses_into_db(expenses, db_path="expenses.db"):
+def _split_html(html_content):
+    """
+    Split large HTML with several tables into one chunk per table, keeping any
+    text before the first table with it. Small inputs stay in one chunk.
+    """
+    if len(html_content) <= EXTRACT_CHUNK_CHARS:
+        return [html_content]
+    chunks = re.split(r'(?=<table)', html_content)
+    if len(chunks) > 1:
+        preamble = chunks.pop(0)
+        chunks[0] = preamble + chunks[0]
+    return chunks
+
+def extract_expenses_from_html(html_content):
+    """
+    Extract expenses from HTML content using UpStage Solar LLM.
+    Plain statement tables are read directly; the LLM handles everything else.
+    """
+    try:
+        return _extract_expenses_from_table(html_content)
+    except (ValueError, IndexError) as e:
+        log.debug("Table fast path not applicable, using LLM: %s", e)
+
+    cache_key = _cache_key(EXTRACT_PROMPT_VERSION, html_content)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    chunks = _split_html(html_content)
+    if len(chunks) == 1:
+        expenses = _solar_extract(html_content)
+    else:
+        # Keep each prompt small and run the per-table calls concurrently
+        with ThreadPoolExecutor(max_workers=EXTRACT_WORKERS) as executor:
+            parts = list(executor.map(_solar_extract, chunks))
+        if any(part is None for part in parts):
+            log.error("Failed to extract expenses from every table.")
+            expenses = None
+        else:
+            expenses = [expense for part in parts for expense in part]
+
+    if expenses is not None:
+        _cache_put(cache_key, EXTRACT_PROMPT_VERSION, expenses)
+    return expenses
+
+def insert_expenses_into_db(expenses, db_path=DB_PATH, pdf_hash=None):
     """
     Insert categorized expenses into the SQLite database.
+    With pdf_hash, the expenses are also cached for that PDF in the same
+    transaction, and nothing is inserted if the PDF was already stored.
     """
-    conn = sqlite3.connect(db_path)
+    conn = _conn(db_path)
     cursor = conn.cursor()
 
     # Create the table if it doesn't exist
@@ -119,34 +486,132 @@ def insert_expenses_into_db(expenses, db_path="expenses.db"):
             category TEXT
         )
     ''')
+    # Index the columns generated queries filter and group by
+    cursor.execute('CREATE INDEX IF NOT EXISTS ix_expenses_date ON expenses(date)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS ix_expenses_cat ON expenses(category)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS ix_expenses_account ON expenses(account)')
+
+    # Insert all expenses with multi-row INSERTs in a single transaction
+    cursor.execute("BEGIN IMMEDIATE")
+    try:
+        if pdf_hash is not None and cursor.execute(
+            'SELECT 1 FROM pdf_cache WHERE sha = ?', (pdf_hash,)
+        ).fetchone():
+            # An identical upload finished first; its rows are already stored
+            cursor.execute("COMMIT")
+            return
+        for i in range(0, len(expenses), INSERT_CHUNK_ROWS):
+            batch = expenses[i:i + INSERT_CHUNK_ROWS]
+            placeholders = ', '.join(['(?, ?, ?, ?)'] * len(batch))
+            # Categories are stored lowercase so generated queries compare them reliably
+            values = [v for e in batch for v in (e['date'], e['account'], e['amount'], e['category'].lower())]
+            cursor.execute(
+                f'INSERT INTO expenses (date, account, amount, category) VALUES {placeholders}',
+                values
+            )
+        # Remember the result so a byte-identical re-upload skips the pipeline
+        if pdf_hash is not None:
+            cursor.execute(
+                'INSERT INTO pdf_cache VALUES (?, ?, ?)',
+                (pdf_hash, orjson.dumps(expenses).decode(), int(time.time()))
+            )
+        cursor.execute("COMMIT")
+    except Exception:
+        cursor.execute("ROLLBACK")
+        raise
 
-    # Insert each expense into the database
-    for expense in expenses:
-        cursor.execute('''
-            INSERT INTO expenses (date, account, amount, category)
-            VALUES (?, ?, ?, ?)
-        ''', (expense['date'], expense['account'], expense['amount'], expense['category']))
+    _refresh_expense_stats(cursor)
 
-    # Commit and close the connection
-    conn.commit()
-    conn.close()
+def _refresh_expense_stats(cursor):
+    """
+    Run ANALYZE on expenses when it has no planner statistics yet or has
+    doubled in size since the last run, so the cost stays amortized.
+    """
+    has_stats = cursor.execute(
+        "SELECT 1 FROM sqlite_master WHERE name = 'sqlite_stat1'"
+    ).fetchone()
+    row = cursor.execute(
+        "SELECT stat FROM sqlite_stat1 WHERE tbl = 'expenses' LIMIT 1"
+    ).fetchone() if has_stats else None
+    analyzed_rows = int(row[0].split()[0]) if row else 0
+    # rowid only grows, so MAX(rowid) is a cheap upper bound on the row count
+    rows = cursor.execute("SELECT MAX(rowid) FROM expenses").fetchone()[0] or 0
+    if row is None or rows >= 2 * analyzed_rows:
+        cursor.execute("ANALYZE expenses")
 
-def process_pdf(pdf_path):
+def get_cached_expenses(pdf_hash):
+    """
+    Return the expenses previously extracted from the PDF with this SHA-256, if any.
+    """
+    row = _conn().execute(
+        'SELECT expenses_json FROM pdf_cache WHERE sha = ?', (pdf_hash,)
+    ).fetchone()
+    return _loads(row[0]) if row else None
+
+def process_pdf(pdf_path, pdf_hash=None):
     # Step 1: Parse the PDF to get HTML content and extract expenses
-    expenses = parse_pdf(pdf_path)
+    with open(pdf_path, "rb") as pdf_file:
+        expenses = parse_pdf(pdf_file, os.path.basename(pdf_path))
 
     # Step 2: Insert categorized expenses into the SQLite database
     if expenses is not None:
-        insert_expenses_into_db(expenses)
+        insert_expenses_into_db(expenses, pdf_hash=pdf_hash)
     else:
-        print("No expenses extracted from HTML.")
+        log.warning("No expenses extracted from HTML.")
 
     return expenses
 
+def _stream_until_sql(url, payload):
+    """
+    Stream a Together chat completion and return the text received so far,
+    closing the connection as soon as it contains a complete SELECT statement.
+    """
+    buffer = ''
+    with together_session.post(url, json={**payload, "stream": True}, stream=True) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            # Server-sent events: only "data: {...}" frames carry tokens
+            if not line.startswith(b'data:'):
+                continue
+            frame = line[len(b'data:'):].strip()
+            if frame == b'[DONE]':
+                break
+            chunk = orjson.loads(frame)
+            buffer += chunk['choices'][0]['delta'].get('content') or ''
+            if _SQL_RE.search(buffer):
+                break
+    return buffer
+
+def _match_intent(question):
+    """
+    Translate common question shapes into a parameterized query without an LLM call.
+    Returns (query, params), or None when no template applies.
+    """
+    for pattern, query in _INTENTS:
+        match = pattern.match(question)
+        if not match:
+            continue
+        params = tuple(value.lower() if value.isalpha() else value for value in match.groups())
+        # Category templates only apply to categories the extractor produces
+        if pattern.groupindex.get('category') and params[0] not in _CATEGORIES:
+            continue
+        return query, params
+    return None
+
 def generate_query(question):
     """
     Generate SQL query using TogetherAI Llama model.
+    Returns (query, params), with query None if no SQL could be generated.
     """
+    intent = _match_intent(question)
+    if intent is not None:
+        return intent
+
+    cache_key = _cache_key(QUERY_PROMPT_VERSION, question)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return cached, ()
+
     url = "https://api.together.xyz/v1/chat/completions"
     payload = {
         "messages": [
@@ -155,39 +620,43 @@ def generate_query(question):
                 "content": f"""Given a database, expenses with the columns: date in YYYY-MM-DD, account in company or person's name with all capitalized letters, amount where positive indicates received money and negative indicates lost money, and category that depends on the company's name and personal names are 'transfers'. Generate a complete and executable SQLite query for the following question: {question}. Ensure the query is in a single line without any extra characters, and ends with a semicolon. The output should be a valid SQL query only. Do not include any additional text or formatting."""
             }
         ],
-        "model": "meta-llama/Meta-Llama-3.1-70B-Instruct-Turbo",
         "stop": ["<|eot_id|>", "<|eom_id|>"],
-        "max_tokens": 150,
         "temperature": 0.5,
         "top_p": 0.7,
         "top_k": 50,
         "repetition_penalty": 1
     }
-    headers = {
-        "accept": "application/json",
-        "content-type": "application/json",
-        "authorization": f"Bearer {TOGETHER_API_KEY}"
-    }
 
     try:
-        response = requests.post(url, json=payload, headers=headers)
-        response.raise_for_status()
-        response_data = response.json()
-        
-        print("Response from TogetherAI:", response_data)  # Debug print
-        
-        query_instruction = response_data['choices'][0]['message']['content']
-        print("Raw Query Instruction:", query_instruction)  # Debug print
-        
-        # Updated regex to handle simpler format
-        match = re.search(r'SELECT .*;', query_instruction, re.DOTALL)
-        if match:
-            return match.group(0).strip()
-        else:
-            print("Error: SQL query not found in response.")
-            return None
+        # Try the small model first; the 70B model is only a fallback
+        for model, max_tokens in QUERY_MODELS:
+            payload["model"] = model
+            payload["max_tokens"] = max_tokens
+            try:
+                query_instruction = _stream_until_sql(url, payload)
+            except (ValueError, KeyError, IndexError) as e:
+                # Fall back to a regular completion if the stream can't be parsed
+                log.warning("Streaming failed, retrying without stream: %s", e)
+                response = together_session.post(url, json=payload)
+                response.raise_for_status()
+                response_data = _loads(response.content)
+
+                log.debug("Response from TogetherAI: %r", response_data)
+
+                query_instruction = response_data['choices'][0]['message']['content']
+            log.debug("Raw Query Instruction: %s", query_instruction)
+
+            # Updated regex to handle simpler format
+            match = _SQL_RE.search(query_instruction)
+            if match:
+                query = match.group(0).strip()
+                _cache_put(cache_key, QUERY_PROMPT_VERSION, query)
+                return query, ()
+
+        log.error("SQL query not found in response.")
+        return None, ()
     except Exception as e:
-        print(f"Error in generate_query: {str(e)}")
+        log.error("Error in generate_query: %s", e)
         raise
 
 def generate_answer(question, data):
@@ -195,7 +664,13 @@ def generate_answer(question, data):
     Generate final answer using TogetherAI Llama model.
     """
     url = "https://api.together.xyz/v1/chat/completions"
-    data_str = str(data)  # Convert data to string if it's a single aggregated result
+    # One row per line, capped to keep the prompt bounded on large result sets
+    data_str = '\n'.join(map(str, data[:MAX_ANSWER_ROWS]))
+
+    cache_key = _cache_key(ANSWER_PROMPT_VERSION, question, data_str)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return cached
     
     payload = {
         "messages": [
@@ -212,35 +687,63 @@ def generate_answer(question, data):
         "top_k": 50,
         "repetition_penalty": 1
     }
-    headers = {
-        "accept": "application/json",
-        "content-type": "application/json",
-        "authorization": f"Bearer {TOGETHER_API_KEY}"
-    }
 
     try:
-        response = requests.post(url, json=payload, headers=headers)
+        response = together_session.post(url, json=payload)
         response.raise_for_status()  # Raises an HTTPError for bad responses
-        response_data = response.json()
+        response_data = _loads(response.content)
         
         # Extract the content of the first choice message
         answer = response_data['choices'][0]['message']['content']
-        print(answer)
-        return answer.strip()
+        log.debug("Answer: %s", answer)
+        answer = answer.strip()
+        _cache_put(cache_key, ANSWER_PROMPT_VERSION, answer)
+        return answer
     except Exception as e:
-        print(f"Error in generate_answer: {str(e)}")
+        log.error("Error in generate_answer: %s", e)
         raise
 
-def fetch_data(query):
+def _parameterize(query):
+    """
+    Replace string literals in a generated query with placeholders, so
+    same-shape queries share one cached prepared statement.
+    Quoted aliases (AS 'total') are left alone, as are queries that
+    already contain placeholders.
+    Returns (query, params).
+    """
+    if '?' in _SQL_STRING_RE.sub('', query):
+        return query, ()
+
+    params = []
+
+    def placeholder(match):
+        if match.group(1):
+            return match.group(0)
+        params.append(match.group(0)[1:-1].replace("''", "'"))
+        return '?'
+
+    return _SQL_STRING_RE.sub(placeholder, query), tuple(params)
+
+def fetch_data(query, params=()):
     """
     Fetch data from SQLite database based on SQL query.
+    Runs on a read-only connection, so generated SQL cannot modify the database.
     """
-    conn = sqlite3.connect('expenses.db')
-    cursor = conn.cursor()
+    cursor = _conn(read_only=True).cursor()
+    cursor.arraysize = 1024
 
-    cursor.execute(query)
-    data = cursor.fetchone()
+    if params:
+        cursor.execute(query, params)
+    else:
+        parameterized, params = _parameterize(query)
+        try:
+            cursor.execute(parameterized, params)
+        except sqlite3.OperationalError:
+            if not params:
+                raise
+            # A literal SQLite reads as an identifier was replaced; run the original
+            cursor.execute(query)
+    data = cursor.fetchall()
 
-    conn.close()
-    print(data)
+    log.debug("Fetched Data: %r", data)
     return data
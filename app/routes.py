@@ -1,18 +1,30 @@
 from flask import Blueprint, request, jsonify, render_template, current_app as app
-from .models import process_pdf, generate_query, fetch_data, generate_answer
+from .models import process_pdf, get_cached_expenses, parse_pdf, insert_expenses_into_db, generate_query, fetch_data, generate_answer
+from concurrent.futures import as_completed
+import io
 import os
 import sqlite3
+import uuid
+import hashlib
+import logging
+import time
 from werkzeug.utils import secure_filename
 
 main = Blueprint('main', __name__)
+log = logging.getLogger(__name__)
 
 # Initialize SQLite database
 DATABASE = 'expenses.db'
 
+# Werkzeug keeps uploads up to this size in memory before spooling them to disk
+SPOOL_MAX_SIZE = 500 * 1024
+
+# Seconds a finished background task stays available to /status
+TASK_TTL = 60 * 60
+
 def init_db():
     """Create the SQLite database and table if they don't exist."""
-    if not os.path.exists('uploads'):
-        os.makedirs('uploads')
+    os.makedirs('uploads', exist_ok=True)
 
     with sqlite3.connect(DATABASE) as conn:
         cursor = conn.cursor()
@@ -25,8 +37,46 @@ def init_db():
                 category TEXT
             )
         ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS ix_expenses_date ON expenses(date)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS ix_expenses_cat ON expenses(category)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS ix_expenses_account ON expenses(account)')
         conn.commit()
 
+def save_and_hash(pdf_file, file_path, chunk_size=64 * 1024):
+    """Streams an uploaded file to disk in chunks, returning its SHA-256 hex digest."""
+    sha = hashlib.sha256()
+    with open(file_path, 'wb') as out:
+        for chunk in iter(lambda: pdf_file.stream.read(chunk_size), b''):
+            sha.update(chunk)
+            out.write(chunk)
+    return sha.hexdigest()
+
+def upload_stream(pdf_file):
+    """Returns the upload as a stream MultipartEncoder can size without spilling it to disk."""
+    stream = pdf_file.stream
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    # Sizing a SpooledTemporaryFile calls fileno(), which rolls it over to disk,
+    # so small in-memory uploads are handed over as BytesIO instead
+    if size <= SPOOL_MAX_SIZE:
+        return io.BytesIO(stream.read())
+    return stream
+
+def process_upload(file_path, pdf_hash):
+    """Processes a saved upload in the background, deleting the file once done."""
+    try:
+        return process_pdf(file_path, pdf_hash)
+    finally:
+        os.remove(file_path)
+
+def evict_stale_tasks(tasks):
+    """Drops finished tasks older than TASK_TTL, including ones nobody polled."""
+    cutoff = time.monotonic() - TASK_TTL
+    for task_id, (future, created_at) in list(tasks.items()):
+        if future.done() and created_at < cutoff:
+            tasks.pop(task_id, None)
+
 @main.route('/')
 def home():
     return render_template('index.html')
@@ -44,40 +94,116 @@ def upload_pdf():
         if pdf_file.filename == '':
             return "No selected file", 400
 
-        # Save the file to the upload folder
+        # Hash the upload into a temporary file, then key everything on the hash
         if pdf_file:
-            filename = secure_filename(pdf_file.filename)
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-            pdf_file.save(file_path)
+            upload_folder = app.config['UPLOAD_FOLDER']
+            temp_path = os.path.join(upload_folder, f"{uuid.uuid4().hex}.part")
+            pdf_hash = save_and_hash(pdf_file, temp_path)
+
+            # A byte-identical re-upload reuses the expenses extracted last time
+            expenses = get_cached_expenses(pdf_hash)
+            if expenses is not None:
+                os.remove(temp_path)
+                return render_template('upload_pdf_results.html', expenses=expenses)
             
-            # Process the PDF
-            expenses = process_pdf(file_path)
-            # Debugging statement
-            print("Expenses passed to template:", expenses)
-            return render_template('upload_pdf_results.html', expenses=expenses)
+            # Process the PDF in the background and let the client poll for it.
+            # The hash is the task id, so an identical upload in flight is shared.
+            tasks = app.extensions['pdf_tasks']
+            with app.extensions['pdf_tasks_lock']:
+                evict_stale_tasks(tasks)
+                task = tasks.get(pdf_hash)
+                if task is not None and not task[0].done():
+                    os.remove(temp_path)
+                else:
+                    file_path = os.path.join(upload_folder, f"{pdf_hash}.pdf")
+                    os.replace(temp_path, file_path)
+                    future = app.extensions['pdf_pool'].submit(process_upload, file_path, pdf_hash)
+                    tasks[pdf_hash] = (future, time.monotonic())
+            return render_template('upload_pdf_status.html', task_id=pdf_hash), 202
     
     return render_template('upload.html')  # Render your upload form
 
+@main.route('/upload-batch', methods=['POST'])
+def upload_pdf_batch():
+    """Parses several uploaded PDFs concurrently and stores their expenses in one insert."""
+    pdf_files = [f for f in request.files.getlist('pdf_files') if f.filename]
+
+    if not pdf_files:
+        return "No selected file", 400
+
+    # Parsing is network-bound, so threads overlap the UpStage round trips
+    expenses = []
+    executor = app.extensions['pdf_batch_pool']
+    # Stream each upload straight to UpStage without copying it into the upload
+    # folder; only uploads Werkzeug already spooled to a temporary file touch disk
+    futures = {
+        executor.submit(parse_pdf, upload_stream(pdf_file), secure_filename(pdf_file.filename)): pdf_file.filename
+        for pdf_file in pdf_files
+    }
+    # One bad PDF shouldn't discard the others, so failures are collected per file
+    failed = []
+    for future in as_completed(futures):
+        try:
+            result = future.result()
+        except Exception as e:
+            log.error("Error processing %s in upload_pdf_batch: %s", futures[future], e)
+            failed.append(futures[future])
+            continue
+        if result:
+            expenses.extend(result)
+
+    if expenses:
+        insert_expenses_into_db(expenses)
+    else:
+        log.warning("No expenses extracted from HTML.")
+
+    return render_template('upload_pdf_results.html', expenses=expenses, failed=failed)
+
+@main.route('/status/<task_id>')
+def upload_status(task_id):
+    """Reports progress of a background PDF task, rendering its expenses once done."""
+    tasks = app.extensions['pdf_tasks']
+    with app.extensions['pdf_tasks_lock']:
+        evict_stale_tasks(tasks)
+        task = tasks.get(task_id)
+
+    if task is None:
+        return jsonify({'error': 'Unknown task'}), 404
+
+    future, _ = task
+    if not future.done():
+        return render_template('upload_pdf_status.html', task_id=task_id), 202
+
+    try:
+        expenses = future.result()
+    except Exception as e:
+        log.error("Error in upload_status: %s", e)
+        return jsonify({'error': str(e)}), 500
+
+    # Debugging statement
+    log.debug("Expenses passed to template: %r", expenses)
+    return render_template('upload_pdf_results.html', expenses=expenses)
+
 @main.route('/ask-question', methods=['POST'])
 def ask_question_route():
     """Handles question input, generates SQL query, fetches data, and renders results in an HTML page."""
     
     # Fetch question from form submission (not JSON since you're using traditional form submission)
     question = request.form.get("question")
-    print(question)
+    log.debug("Question: %s", question)
 
     if not question:
         return jsonify({'error': 'Question is required'}), 400
 
     try:
         # Generate SQL query from the question
-        query = generate_query(question)
+        query, params = generate_query(question)
         
         if not query:
             return jsonify({'error': 'Failed to generate SQL query'}), 500
 
         # Fetch data from the database using the generated query
-        data = fetch_data(query)
+        data = fetch_data(query, params)
 
         if not data:
             return jsonify({'error': 'No data found for the generated query'}), 404
@@ -89,7 +215,7 @@ def ask_question_route():
         return render_template('ask_questions_results.html', question=question, answer=answer)
 
     except Exception as e:
-        print(f"Error in ask_question_route: {str(e)}")
+        log.error("Error in ask_question_route: %s", e)
         return jsonify({'error': str(e)}), 500
 
 
@@ -0,0 +1,5 @@
+import os
+
+# The API clients in app.models are created at import time and need keys
+os.environ.setdefault('UPSTAGE_API_KEY', 'test')
+os.environ.setdefault('TOGETHER_API_KEY', 'test')
@@ -0,0 +1,201 @@
+import sqlite3
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from app import models
+
+
+@pytest.mark.parametrize('question, expected', [
+    ("What is the total I spent on Food?",
+     ('SELECT SUM(amount) FROM expenses WHERE category = ? COLLATE NOCASE;', ('food',))),
+    ("How much did I spend on food?",
+     ('SELECT SUM(amount) FROM expenses WHERE category = ? COLLATE NOCASE;', ('food',))),
+    ("List all food expenses",
+     ('SELECT date, account, amount, category FROM expenses WHERE category = ? COLLATE NOCASE ORDER BY date;', ('food',))),
+    ("Show me transactions between 2024-01-01 and 2024-01-31.",
+     ('SELECT date, account, amount, category FROM expenses WHERE date BETWEEN ? AND ? ORDER BY date;',
+      ('2024-01-01', '2024-01-31'))),
+])
+def test_match_intent(question, expected):
+    assert models._match_intent(question) == expected
+
+
+@pytest.mark.parametrize('question', [
+    "In March, how much did I spend on food?",
+    "How much did I spend in 2023 on food?",
+    "Excluding rent, what is the total I spent on food?",
+    "How much did I spend on food in March?",
+    "Between 2024-01-01 and 2024-01-31, list my food expenses",
+    "List all food expenses in March",
+    "How much did I spend on NETFLIX?",
+])
+def test_match_intent_leaves_qualified_questions_to_llm(question):
+    assert models._match_intent(question) is None
+
+
+def test_insert_with_pdf_hash_stores_rows_once(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(models, '_tls', threading.local())
+    expenses = [{'date': '2024-03-01', 'account': 'RAJ', 'amount': -50.0, 'category': 'transfers'}]
+
+    models.insert_expenses_into_db(expenses, pdf_hash='abc')
+    models.insert_expenses_into_db(expenses, pdf_hash='abc')
+
+    assert models.fetch_data('SELECT COUNT(*) FROM expenses;') == [(1,)]
+    assert models.get_cached_expenses('abc') == expenses
+
+
+@pytest.mark.parametrize('query, expected', [
+    ("SELECT SUM(amount) FROM expenses WHERE category = 'food';",
+     ("SELECT SUM(amount) FROM expenses WHERE category = ?;", ('food',))),
+    ("SELECT SUM(amount) AS 'total' FROM expenses WHERE account = 'O''B';",
+     ("SELECT SUM(amount) AS 'total' FROM expenses WHERE account = ?;", ("O'B",))),
+    ("SELECT * FROM expenses WHERE category = ? AND account = 'RAJ';",
+     ("SELECT * FROM expenses WHERE category = ? AND account = 'RAJ';", ())),
+])
+def test_parameterize(query, expected):
+    assert models._parameterize(query) == expected
+
+
+@pytest.mark.parametrize('query', [
+    "SELECT SUM(amount) AS 'total' FROM expenses WHERE category = 'food';",
+    "SELECT SUM(amount) 'total' FROM expenses WHERE category = 'food';",
+])
+def test_fetch_data_with_quoted_alias(query, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(models, '_tls', threading.local())
+    models.insert_expenses_into_db([{'date': '2024-03-01', 'account': 'A', 'amount': -5.0, 'category': 'food'}])
+
+    assert models.fetch_data(query) == [(-5.0,)]
+
+
+def _statement(*rows):
+    cells = ''.join(
+        f'<tr><td>{date}</td><td>{description}</td><td>{amount}</td></tr>'
+        for date, description, amount in rows
+    )
+    return f'<table><tr><th>Date</th><th>Description</th><th>Amount</th></tr>{cells}</table>'
+
+
+def test_extract_expenses_from_table():
+    html = _statement(
+        ('2024-03-01', 'FUND TRANSFER TO A/ RAJ', '50.00-'),
+        ('02 Mar 2024', 'NETFLIX.COM SG', '1,015.90-'),
+        ('', 'Total', '1,065.90-'),
+    )
+
+    assert models._extract_expenses_from_table(html) == [
+        {'date': '2024-03-01', 'account': 'RAJ', 'amount': -50.0, 'category': 'transfers'},
+        {'date': '2024-03-02', 'account': 'NETFLIX', 'amount': -1015.9, 'category': 'subscriptions'},
+    ]
+
+
+@pytest.mark.parametrize('row', [
+    ('2024-03-01', 'POS HOTEL CHOCOLATE', '12.00-'),
+    ('2024-03-01', 'STEAMBOAT HOUSE', '30.00-'),
+    ('2024-03-01', 'GIRO TRANSFER FROM EMPLOYER ACME', '3,000.00+'),
+    ('03/04/2024', 'NETFLIX.COM SG', '15.90-'),
+    ('2024-03-01', 'FUND TRANSFER TO A/ RAJ', '50.00'),
+    ('2024-03-01', 'FUND TRANSFER TO A/ RAJ', '-50.00-'),
+    ('2024-03-01', 'FUND TRANSFER TO A/ ACME PTE LTD', '50.00-'),
+    ('2024-03-01', 'FUND TRANSFER TO A/ ACME.COM', '50.00-'),
+])
+def test_extract_expenses_from_table_falls_back_on_ambiguous_rows(row):
+    with pytest.raises(ValueError):
+        models._extract_expenses_from_table(_statement(row))
+
+
+@pytest.mark.parametrize('text, expected', [
+    ("Here you go: SELECT SUM(amount) FROM expenses; Hope this helps.",
+     "SELECT SUM(amount) FROM expenses;"),
+    ("SELECT * FROM expenses WHERE account = 'A;B';",
+     "SELECT * FROM expenses WHERE account = 'A;B';"),
+    ("SELECT * FROM expenses WHERE account = 'O''B;';",
+     "SELECT * FROM expenses WHERE account = 'O''B;';"),
+])
+def test_sql_re(text, expected):
+    assert models._SQL_RE.search(text).group(0) == expected
+
+
+def test_sql_re_waits_for_closing_quote():
+    assert models._SQL_RE.search("SELECT * FROM expenses WHERE account = 'A;") is None
+
+
+def _solar_replying(content):
+    reply = SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))])
+    create = lambda **kwargs: reply
+    return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+
+
+@pytest.mark.parametrize('content', [
+    '{"expenses": [{"date": "2024-03-01", "account": "RAJ", "amount": -5, "category": "transfers"}]}',
+    '[{"date": "2024-03-01", "account": "RAJ", "amount": -5}]',
+    '["2024-03-01"]',
+])
+def test_extract_expenses_rejects_and_does_not_cache_bad_shapes(content, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(models, '_tls', threading.local())
+    monkeypatch.setattr(models, 'solar_client', _solar_replying(content))
+
+    assert models.extract_expenses_from_html('<p>statement</p>') is None
+    assert models._conn().execute('SELECT COUNT(*) FROM llm_cache').fetchone() == (0,)
+
+
+def test_cache_put_drops_expired_entries(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(models, '_tls', threading.local())
+    models._conn().execute("INSERT INTO llm_cache VALUES ('old', 'v', '1', 0, 1)")
+
+    models._cache_put('new', 'v', 2)
+
+    keys = models._conn().execute('SELECT input_hash FROM llm_cache').fetchall()
+    assert keys == [('new',)]
+
+
+def test_insert_creates_planner_stats(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(models, '_tls', threading.local())
+    expense = {'date': '2024-03-01', 'account': 'RAJ', 'amount': -50.0, 'category': 'transfers'}
+
+    models.insert_expenses_into_db([expense] * 10)
+    models.insert_expenses_into_db([expense] * 20)
+
+    stats = models._conn().execute(
+        "SELECT stat FROM sqlite_stat1 WHERE tbl = 'expenses' LIMIT 1"
+    ).fetchone()
+    assert stats[0].split()[0] == '30'
+
+
+def test_category_intent_matches_any_case(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(models, '_tls', threading.local())
+    models.insert_expenses_into_db([{'date': '2024-03-01', 'account': 'KFC', 'amount': -5.0, 'category': 'Food'}])
+    # Rows stored before categories were lowercased on insert
+    models._conn().execute("INSERT INTO expenses (date, account, amount, category) VALUES ('2024-03-02', 'KFC', -7.0, 'Food')")
+
+    assert models.fetch_data('SELECT DISTINCT category FROM expenses ORDER BY category;') == [('Food',), ('food',)]
+    assert models.fetch_data(*models._match_intent('How much did I spend on food?')) == [(-12.0,)]
+
+
+@pytest.mark.parametrize('query', [
+    "DROP TABLE expenses;",
+    "DELETE FROM expenses;",
+    "UPDATE expenses SET amount = 0;",
+    "INSERT INTO expenses (date, account, amount, category) VALUES ('2024-01-01', 'X', 1, 'food');",
+    "ATTACH DATABASE 'other.db' AS other;",
+    "PRAGMA journal_mode=DELETE;",
+])
+def test_fetch_data_rejects_writes(query, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(models, '_tls', threading.local())
+    models.insert_expenses_into_db([{'date': '2024-03-01', 'account': 'RAJ', 'amount': -50.0, 'category': 'transfers'}])
+
+    with pytest.raises(sqlite3.DatabaseError):
+        models.fetch_data(query)
+
+    assert models.fetch_data('SELECT date, account, amount, category FROM expenses;') == [
+        ('2024-03-01', 'RAJ', -50.0, 'transfers')
+    ]
+    assert not (tmp_path / 'other.db').exists()